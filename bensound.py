@@ -6,12 +6,125 @@
 from io import BytesIO
 from PIL import Image
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pathlib
 import sqlite3
 import datetime
-from bs4 import BeautifulSoup
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import lxml.html
+from lxml import etree
 
 TODAY = datetime.datetime.today().strftime('%Y-%m-%d')
+USER_AGENT = 'bensound-api/1.0'
+MAX_WORKERS = 20
+CHANNEL_WORKERS = 8
+MAX_CONNECTIONS = 32
+CHUNK_SIZE = 65536
+RANGE_PARTS = 4
+RANGE_MIN_SIZE = 1048576  # bytes
+CACHE_PATH = 'bensound_cache.sqlite'
+CACHE_EXPIRE = 86400  # seconds
+SITE_URL = 'https://www.bensound.com/'
+
+
+def _has_class(name):
+    """Return an xpath predicate matching elements that carry the css class `name`"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+# compiled xpath queries for site navigation
+XPATH_MENU_LINKS = etree.XPath('//div[@id="menu"]//a')
+XPATH_PAGINATION = etree.XPath(f'(//div[{_has_class("pagenavi")}])[1]//a[{_has_class("page")}]/@href')
+
+# compiled xpath queries for the song media blocks
+XPATH_BLOCKS = etree.XPath(
+    f'(//div[{_has_class("bloc_cat")}])[1]'
+    f'//div[{_has_class("bloc_produit")} or {_has_class("bloc_produit1")}]')
+# a single pass over the block collects every node that carries a song attribute; nodes
+# are then matched to attributes by tag and class in python
+XPATH_BLOCK_FIELDS = etree.XPath(' | '.join([
+    f'.//div[{_has_class("titre")}]',
+    f'.//p[{_has_class("totime")}]',
+    f'.//div[{_has_class("description")}]',
+    f'.//div[{_has_class("img_mini")}]',
+    './/audio',
+    f'.//div[{_has_class("bouton_download")}]',
+    f'.//div[{_has_class("bouton_purchase")}]',
+    f'.//div[{_has_class("pop_license")}]',
+    f'.//span[{_has_class("nothis")}]',
+]))
+BLOCK_FIELD_CLASSES = {'titre', 'totime', 'description', 'img_mini', 'bouton_download',
+                       'bouton_purchase', 'pop_license', 'nothis'}
+
+
+def _text(node):
+    """Return the stripped text content of an element, or an empty string if it is missing"""
+    return node.text_content().strip() if node is not None else ''
+
+
+def _attribute(node, path, name):
+    """Return attribute `name` of the first element at `path` below `node`, or an empty string"""
+    element = node.find(path) if node is not None else None
+    return element.get(name, '') if element is not None else ''
+
+
+def _scrape_block_attributes(block):
+    """Extract attributes for a single block_div media container and return as a dictionary"""
+    # keep the first node found for each attribute; license restrictions may repeat
+    nodes = {}
+    restrictions = []
+    for node in XPATH_BLOCK_FIELDS(block):
+        if node.tag == 'audio':
+            nodes.setdefault('audio', node)
+            continue
+        for name in BLOCK_FIELD_CLASSES.intersection(node.get('class', '').split()):
+            if name == 'nothis':
+                restrictions.append(node)
+            else:
+                nodes.setdefault(name, node)
+
+    attr = {}
+    titre = nodes.get('titre')
+    attr['title'] = _text(titre.find('p') if titre is not None else None)
+    attr['length'] = _text(nodes.get('totime'))
+    attr['description'] = _text(nodes.get('description'))
+    attr['url_main'] = _attribute(nodes.get('img_mini'), './/a', 'href')
+    attr['url_image'] = SITE_URL + _attribute(nodes.get('img_mini'), './/img', 'src')
+    audio = nodes.get('audio')
+    attr['url_mp3'] = SITE_URL + (audio.get('src', '') if audio is not None else '')
+
+    # available for download
+    attr['for_download'] = 'bouton_download' in nodes
+
+    # available for purchase
+    attr['for_purchase'] = 'bouton_purchase' in nodes
+    pop_license = nodes.get('pop_license')
+    attr['url_purchase'] = _attribute(pop_license, './/a', 'href') if attr['for_purchase'] else ''
+
+    # media license
+    h1_tag = pop_license.find('.//h1') if pop_license is not None else None
+    l1 = _text(h1_tag) + '.' if h1_tag is not None else ""
+    p_tag = pop_license.find('.//p') if pop_license is not None else None
+    l2 = _text(p_tag) + '.' if p_tag is not None else ""
+    l3 = ", ".join([_text(span) for span in restrictions])
+    attr['license'] = " ".join([l1, l2, l3]).strip().replace('\xa0', ' ') + '.'
+
+    return attr
+
+
+def _parse_page(content):
+    """Parse raw page content and return the song attributes of each media block as a list
+    of dictionaries, along with the pagination urls found on the page. Defined at module level
+    so that it can be run in a separate process."""
+    tree = lxml.html.fromstring(content)
+    attributes = [_scrape_block_attributes(block) for block in XPATH_BLOCKS(tree)]
+    page_urls = [str(url) for url in XPATH_PAGINATION(tree)]
+    return attributes, page_urls
+
 
 class BensoundAPI:
     """An API for accessing the music, metadata, and associated images from the 
@@ -61,34 +174,75 @@ class BensoundAPI:
         Extract song data for all songs in a specified channel, or returns all songs
         if no channel is provided.
 
-    extract_all_data()
+    extract_all_data(parse_processes=None)
         Extracts all available music data from www.bensound.com and updates the class attributes
         `channels`, `channel_playlist`, and `music_list`. Does NOT download the MP3 files.    
+
+    download_all(destination=None, max_workers=8)
+        Download the mp3 files for all songs in `music_lists` concurrently.
+
+    prefetch_art(songs=None)
+        Fetch the artwork for many songs concurrently and return a dictionary of song
+        titles and image objects.
+
+    refresh()
+        Clear the local page cache so the next extraction re-crawls www.bensound.com.
+
+    close()
+        Close the local page cache.
     """
-    def __init__(self):
+    def __init__(self, cache_path=CACHE_PATH):
         self.channels = None
         self.channel_playlist = None
         self.music_lists = None
-
-    def extract_all_data(self):
+        self._title_index = {}
+        self._parse_pool = None
+        self._session = self.__create_session()
+        self._request_limit = threading.BoundedSemaphore(MAX_CONNECTIONS)
+        self._cache_lock = threading.Lock()
+        self._cache = self.__open_cache(cache_path) if cache_path else None
+
+    def extract_all_data(self, parse_processes=None):
         """Extracts all available music data from www.bensound.com and updates the class attributes
         `channels`, `channel_playlist`, and `music_list`. Does NOT download the MP3 files.
+
+        Parameters
+        ----------
+        parse_processes : int, optional
+            Parse pages in a pool of this many worker processes instead of in-process. Worker
+            processes are spawned, so scripts using this option must guard their entry point
+            with `if __name__ == '__main__':`.
         """
-        unique_titles = []
-        media_list = [] 
+        seen = set()
+        media_list = []
         if not self.channels:
             self.extract_channels()
         channels = list(self.channels.keys())
         channel_playlist = {channel: [] for channel in channels}
 
-        for channel_name in channels:
-            channel_media = self.extract_channel_music(channel_name)
+        # optionally parse pages across cpu cores; workers are spawned rather than forked
+        # because forking a process that is running fetch threads can deadlock
+        if parse_processes:
+            self._parse_pool = ProcessPoolExecutor(
+                max_workers=parse_processes, mp_context=multiprocessing.get_context('spawn'))
+
+        # scrape channels concurrently, then merge serially to keep ordering stable
+        try:
+            with ThreadPoolExecutor(max_workers=CHANNEL_WORKERS) as executor:
+                results = dict(zip(channels, executor.map(self.extract_channel_music, channels)))
+        finally:
+            if self._parse_pool:
+                self._parse_pool.shutdown()
+                self._parse_pool = None
+
+        for channel_name, channel_media in results.items():
             for song in channel_media:
                 channel_playlist[channel_name].append(song.title)
-                if song.title not in unique_titles:
-                    unique_titles.append(song.title)
+                if song.title not in seen:
+                    seen.add(song.title)
                     media_list.append(song)
         self.music_lists = ([song.title for song in media_list], media_list)
+        self._title_index = {title: i for i, title in enumerate(self.music_lists[0])}
         self.channel_playlist = channel_playlist
 
         # report results
@@ -105,9 +259,9 @@ class BensoundAPI:
         dict
             channel name and channel url
         """
-        soup = self.__get_page_soup('https://www.bensound.com/')
-        menu_tags = soup.find('div', id='menu').find_all('a')
-        channels = {tag.text: tag['href'] for tag in menu_tags if tag.text != 'All'}
+        tree = lxml.html.fromstring(self.__get_page_content(SITE_URL))
+        menu_tags = XPATH_MENU_LINKS(tree)
+        channels = {tag.text_content(): tag.get('href') for tag in menu_tags if tag.text_content() != 'All'}
         self.channels = channels
         return channels        
 
@@ -132,25 +286,87 @@ class BensoundAPI:
 
         """
         if not self.channels:
-            self.extract_channels
+            self.extract_channels()
         channel_url = self.channels[channel_name]
-        urls_to_fetch = [channel_url]
-        urls_fetched = []
         songlist = []
-
-        while urls_to_fetch:
-            url = urls_to_fetch.pop(0) # get first url in list
-            urls_fetched.append(url)
-            soup = self.__get_page_soup(url) # extract html for parsing
-            # find additional pages that may existing via pagination
-            pages = self.__get_pagination(soup, urls_to_fetch, urls_fetched)
-            if pages:
-                urls_to_fetch.extend(pages)
-            # extract the names of all songs from the page
-            songlist.extend(self.__scrape_page_data(soup))
+        attributes, page_urls = self.__parse_pages([self.__get_page_content(channel_url)])[0]
+        songlist.extend(self.__create_songs(attributes))
+        urls_fetched = {channel_url}
+
+        # find additional pages that may exist via pagination and fetch them concurrently;
+        # newly discovered pages are fetched in another pass until none are left
+        urls_to_fetch = list(dict.fromkeys(self.__get_pagination(page_urls, {}, urls_fetched)))
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            while urls_to_fetch:
+                urls_fetched.update(urls_to_fetch)
+                new_pages = {}  # insertion-ordered set of newly discovered pages
+                contents = list(executor.map(self.__get_page_content, urls_to_fetch))
+                for attributes, page_urls in self.__parse_pages(contents):
+                    new_pages.update(dict.fromkeys(self.__get_pagination(page_urls, new_pages, urls_fetched)))
+                    # extract the names of all songs from the page
+                    songlist.extend(self.__create_songs(attributes))
+                urls_to_fetch = list(new_pages)
 
         return songlist
 
+    def download_all(self, destination=None, max_workers=8):
+        """Download the mp3 files for all songs in `music_lists` concurrently.
+
+        Parameters
+        ----------
+        destination : string, optional
+            The local file location used to save the downloaded mp3 files.
+
+        max_workers : int, optional
+            The number of songs to download at the same time.
+
+        Returns
+        -------
+        None
+        """
+        if not self.music_lists or not self.music_lists[1]:
+            print('No songs available')
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda song: song.download_mp3(destination), self.music_lists[1]))
+
+    def prefetch_art(self, songs=None):
+        """Fetch the artwork for many songs concurrently, such as for a grid of album covers.
+
+        Parameters
+        ----------
+        songs : list of Song, optional
+            The songs to fetch artwork for; defaults to all songs in `music_lists`.
+
+        Returns
+        -------
+        dict
+            song title and image object
+        """
+        if songs is None:
+            songs = self.music_lists[1] if self.music_lists else []
+        with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as executor:
+            images = executor.map(lambda song: song.get_song_art(), songs)
+            return {song.title: image for song, image in zip(songs, images)}
+
+    def refresh(self):
+        """Clear the local page cache so the next extraction re-crawls www.bensound.com"""
+        if self._cache:
+            with self._cache_lock, self._cache:
+                self._cache.execute('DELETE FROM pages')
+
+    def close(self):
+        """Close the local page cache"""
+        if self._cache:
+            with self._cache_lock:
+                self._cache.close()
+                self._cache = None
+
+    def __del__(self):
+        # the cache may not exist if __init__ failed part way
+        if getattr(self, '_cache', None):
+            self._cache.close()
+
     def get_channel_list(self):
         """A convience method to print a list of channels"""
         if self.channels:
@@ -210,93 +426,85 @@ class BensoundAPI:
 
     def get_song_by_title(self, song_title):
         """Retrieve a song object by finding the first song with the title corresponding to `song_title`"""
-        song_names = self.music_lists[0]
-        song_objects = self.music_lists[1]
-        if song_names:
-            song_index = song_names.index(song_title)
-            if song_index:
-                try:
-                    return song_objects[song_index]
-                except IndexError:
-                    print('Bad song index')
-            else:
+        if self.music_lists and self.music_lists[0]:
+            try:
+                return self.music_lists[1][self._title_index[song_title]]
+            except KeyError:
                 print('Song does not exists by that name')
         else:
             print('No songs currently available in `music_lists`')
 
 
-    def __scrape_page_data(self, soup):
-        """Extract media attributes for all media block containers on a page"""
-        media_list = []
-        block_container = soup.find('div', 'bloc_cat')
-        blocks = block_container.find_all('div', ['bloc_produit', 'bloc_produit1'])
-        for block in blocks:
-            attributes = self.__scrape_block_attributes(block)
-            song = Song(**attributes)
-            media_list.append(song)
-        return media_list      
+    def __parse_pages(self, contents):
+        """Parse raw page contents, in the process pool when one is active, and return the
+        song attributes and pagination urls of each page"""
+        if self._parse_pool:
+            return list(self._parse_pool.map(_parse_page, contents))
+        return [_parse_page(content) for content in contents]
 
-    @staticmethod
-    def __get_page_soup(url):
-        """Request site content and return as BeautifulSoup object"""
-        response = requests.get(url)
-        if response.ok:
-            return BeautifulSoup(response.text, 'lxml')
+    def __create_songs(self, attributes):
+        """Create song objects from a list of song attribute dictionaries"""
+        return [Song(session=self._session, **attr) for attr in attributes]
 
     @staticmethod
-    def __get_pagination(soup, to_fetch, fetched):
-        """Extract all pagination urls and return new items as a list"""
-        nav_tags = soup.find('div', 'pagenavi').find_all('a', 'page')
-        new_pages = []
-        if nav_tags:
-            for tag in nav_tags:
-                url = tag['href']
-                if url not in to_fetch and url not in fetched:
-                    new_pages.append(url)
-        return new_pages
+    def __create_session():
+        """Create a shared http session that keeps connections to www.bensound.com alive"""
+        session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.3)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONNECTIONS, max_retries=retries)
+        session.mount('https://', adapter)
+        session.headers.update({'User-Agent': USER_AGENT})
+        return session
 
+    @staticmethod
+    def __open_cache(cache_path):
+        """Open the sqlite page cache, creating the table if it does not exist"""
+        cache = sqlite3.connect(cache_path, check_same_thread=False)
+        with cache:
+            cache.execute('CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, content BLOB, fetched REAL)')
+        return cache
+
+    def __read_cache(self, url):
+        """Return cached page content for `url` if it has not expired"""
+        if not self._cache:
+            return
+        with self._cache_lock:
+            row = self._cache.execute(
+                'SELECT content FROM pages WHERE url = ? AND fetched > ?',
+                (url, time.time() - CACHE_EXPIRE)).fetchone()
+        if row:
+            return row[0]
+
+    def __write_cache(self, url, content):
+        """Store page content for `url` in the cache"""
+        if not self._cache:
+            return
+        with self._cache_lock, self._cache:
+            self._cache.execute(
+                'INSERT OR REPLACE INTO pages (url, content, fetched) VALUES (?, ?, ?)',
+                (url, content, time.time()))
+
+    def __get_page_content(self, url):
+        """Request site content, or read it from the cache, and return as bytes"""
+        content = self.__read_cache(url)
+        if content is None:
+            # cap in-flight page requests across all worker threads to the connection pool size
+            with self._request_limit:
+                response = self._session.get(url, timeout=10)
+            if not response.ok:
+                return
+            content = response.content
+            self.__write_cache(url, content)
+        return content
 
     @staticmethod
-    def __scrape_block_attributes(block):
-        """Extract attributes for a single block_div media container and return as a dictionary"""
-        attr = {}
-        site_url = 'https://www.bensound.com/'
-        attr['title'] = block.find('div', 'titre').p.text.strip()
-        attr['length'] = block.find('p', 'totime').text.strip()
-        attr['description'] = block.find('div', 'description').text.strip()
-        attr['url_main'] = block.find('div', 'img_mini').a['href']
-        attr['url_image'] = site_url + block.find('div', 'img_mini').img['src']
-        attr['url_mp3'] = site_url + block.find('audio')['src']
-        
-        # available for download
-        try:
-            block.find('div', 'bouton_download').text.strip()
-            attr['for_download'] = True
-        except AttributeError:
-            attr['for_download'] = False    
-            
-        # available for purchase
-        try:
-            block.find('div', 'bouton_purchase').text.strip()
-            attr['for_purchase'] = True
-            attr['url_purchase'] = block.find('div', 'pop_license').a['href']
-        except AttributeError:
-            attr['for_purchase'] = False
-            attr['url_purchase'] = ''
-            
-        # media license
-        try:
-            l1 = block.find('div', 'pop_license').h1.text.strip() + '.'
-        except AttributeError:
-            l1 = ""
-        try:
-            l2 = block.find('div', 'pop_license').p.text.strip() + '.'
-        except AttributeError:
-            l2 = ""
-        l3 = ", ".join([span.text.strip() for span in block.find_all('span', 'nothis')])
-        attr['license'] = " ".join([l1, l2, l3]).strip().replace('\xa0', ' ') + '.'
-        
-        return attr
+    def __get_pagination(page_urls, to_fetch, fetched):
+        """Filter the pagination urls of a page and return new items as a list"""
+        new_pages = []
+        for url in page_urls:
+            if url not in to_fetch and url not in fetched:
+                new_pages.append(url)
+        return new_pages
 
 
 class Song:
@@ -357,7 +565,10 @@ class Song:
         any music containing voicevers from www.bensound.com to access the clean
         version of the song.
     """
-    def __init__(self, **kwargs):
+    __slots__ = ('title', 'length', 'description', 'for_download', 'for_purchase', 'license',
+                 'url_main', 'url_image', 'url_mp3', 'url_purchase', 'modified', '_session')
+
+    def __init__(self, session=None, **kwargs):
         self.title = kwargs['title']
         self.length = kwargs['length']
         self.description = kwargs['description']
@@ -368,7 +579,12 @@ class Song:
         self.url_image = kwargs['url_image']
         self.url_mp3 = kwargs['url_mp3']
         self.url_purchase = kwargs['url_purchase']
-        self.modified = datetime.datetime.today().strftime('%Y-%m-%d')
+        self.modified = TODAY
+        self._session = session
+
+    def __http(self):
+        """Return the shared session, or the requests module for songs created without one"""
+        return self._session or requests
 
     def get_properties(self):
         """Get and return object properties as a dictionary. Useful for uploading
@@ -379,7 +595,7 @@ class Song:
         dict
             A dictionary containing all object properties
         """
-        return self.__dict__
+        return {slot: getattr(self, slot) for slot in self.__slots__ if not slot.startswith('_')}
 
     def get_song_stream(self):
         """Get and return streaming bytes object
@@ -389,7 +605,7 @@ class Song:
         BytesIO
             A streaming BytesIO object for media playback.
         """
-        response = requests.get(self.url_mp3, stream=True)
+        response = self.__http().get(self.url_mp3, stream=True)
         if response.ok:
             stream = BytesIO(response.content)
             return stream
@@ -403,7 +619,7 @@ class Song:
         Image
             An image object.
         """
-        response = requests.get(self.url_image)
+        response = self.__http().get(self.url_image, timeout=10)
         if response.ok:
             img_bytes = BytesIO(response.content)
             image = Image.open(img_bytes)
@@ -429,9 +645,48 @@ class Song:
         # where will this file be saved?
         path = pathlib.Path(destination) if destination else pathlib.Path().cwd()
         filename = self.url_mp3.split('/')[-1]
-        
-        # download and save the file
-        response = requests.get(self.url_mp3)
-        if response.ok:
-            with open(filename, 'wb') as f:
-                f.write(response.content)
+        filepath = path / filename
+
+        # large files are fetched as parallel byte ranges when the server supports it
+        head = self.__http().head(
+            self.url_mp3, headers={'Accept-Encoding': 'identity'}, allow_redirects=True, timeout=10)
+        size = int(head.headers.get('Content-Length', 0)) if head.ok else 0
+        if size >= RANGE_MIN_SIZE and head.headers.get('Accept-Ranges') == 'bytes':
+            if self.__download_ranges(filepath, size):
+                return
+
+        # stream the file to disk in chunks instead of buffering it in memory
+        with self.__http().get(self.url_mp3, stream=True, timeout=10) as response:
+            if response.ok:
+                with open(filepath, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+
+    def __download_ranges(self, filepath, size):
+        """Download the mp3 file as concurrent byte ranges written into a preallocated file.
+        Returns False, after removing the partial file, if any range fails or is not honored."""
+        with open(filepath, 'wb') as f:
+            f.truncate(size)
+        ranges = [(i * size // RANGE_PARTS, (i + 1) * size // RANGE_PARTS - 1) for i in range(RANGE_PARTS)]
+        try:
+            with ThreadPoolExecutor(max_workers=RANGE_PARTS) as executor:
+                completed = all(list(executor.map(lambda r: self.__download_range(filepath, *r), ranges)))
+        except requests.RequestException:
+            completed = False
+        if not completed:
+            filepath.unlink()
+        return completed
+
+    def __download_range(self, filepath, start, end):
+        """Download a single byte range of the mp3 file into its position in the file"""
+        headers = {'Range': f'bytes={start}-{end}', 'Accept-Encoding': 'identity'}
+        with self.__http().get(self.url_mp3, headers=headers, stream=True, timeout=10) as response:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status_code != 206 or not content_range.startswith(f'bytes {start}-{end}/'):
+                return False
+            written = 0
+            with open(filepath, 'r+b') as f:
+                f.seek(start)
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    written += f.write(chunk)
+        return written == end - start + 1